@@ -1,4 +1,4 @@
-from flask import Flask, request, jsonify, session, send_from_directory
+from flask import Flask, request, jsonify, session, send_from_directory, g, has_request_context
 from flask_limiter import Limiter
 from flask_limiter.util import get_remote_address
 from flask_cors import CORS
@@ -7,6 +7,14 @@ import requests, os, random
 from werkzeug.middleware.proxy_fix import ProxyFix
 #new pip 
 import base64, io
+import time, hashlib, threading, atexit, stat
+from collections import deque, OrderedDict
+import router
+from upstream_json import (
+    json_dumps, json_loads, gemini_payload, groq_payload, gemini_url,
+    parse_gemini_reply, parse_groq_reply,
+)
+import limiter_storage  # registers sqlite:// with flask-limiter
 from PIL import Image
 import PyPDF2
 from flask import Response
@@ -187,10 +195,14 @@ def external_api_guard():
 
 
 # -------------------- RATE LIMITER --------------------
+# counters live in one SQLite file shared by every worker on the node
+# (see limiter_storage.py), sliding window so limits don't reset on the minute
 limiter = Limiter(
     key_func=get_remote_address,
     app=app,
-    default_limits=["30 per minute"]  # shared IP safe
+    default_limits=["30 per minute"],  # shared IP safe
+    storage_uri=os.getenv("RATELIMIT_STORAGE_URI", limiter_storage.default_uri()),
+    strategy="sliding-window-counter"
 )
 
 # -------------------- SECURITY + CACHE HEADERS --------------------
@@ -218,13 +230,12 @@ def load_keys(prefix):
 GEMINI_KEYS = load_keys("GEMINI_KEY_")
 GROQ_KEYS   = load_keys("GROQ_KEY_")
 
+ROUTER = router.Router(adaptive=os.getenv("ADAPTIVE_ROUTING", "1") == "1")
+ROUTER.set_key_count("gemini", len(GEMINI_KEYS))
+ROUTER.set_key_count("groq", len(GROQ_KEYS))
+
 # -------------------- MODELS --------------------
-MODELS = {
-    "smart": ["gemma-3-1b-it"],
-    "internet": ["gemini-3-flash-preview", "gemini-2.5-flash-lite"],
-    "think": ["gemini-3-flash-think"],
-    "flash": ["llama-3.1-8b-instant"],
-}
+# per-mode model tiers live in router.ROUTES
 
 MAX_CONTEXT = 4
 
@@ -235,111 +246,489 @@ def get_context():
 def trim_context(ctx):
     return ctx[-MAX_CONTEXT * 2:]
 
-# -------------------- GEMINI CALL --------------------
-def call_gemini(prompt, model, internet=False):
-    for key in random.sample(GEMINI_KEYS, len(GEMINI_KEYS)):
+# -------------------- UPSTREAM HTTP --------------------
+# JSON encode / decode helpers live in upstream_json.py
+# keep-alive pool shared by all upstream calls (no TLS handshake per request)
+HTTP = requests.Session()
+
+JSON_HEADERS = {"Content-Type": "application/json"}
+
+# -------------------- USAGE ACCOUNTING --------------------
+# Every upstream attempt is queued in a per-process ring buffer and a
+# background thread flushes it in bulk to one JSONL file per UTC day in
+# USAGE_LOG_DIR (shared by all workers, kept USAGE_RETENTION_DAYS) or
+# to Firestore when USAGE_SINK=firestore.
+# /admin/usage-summary reads the sink, so it covers every worker.
+USAGE_RING_SIZE   = int(os.getenv("USAGE_RING_SIZE", "5000"))
+USAGE_FLUSH_EVERY = int(os.getenv("USAGE_FLUSH_EVERY", "200"))
+USAGE_FLUSH_SECS  = int(os.getenv("USAGE_FLUSH_SECS", "60"))
+USAGE_SINK        = os.getenv("USAGE_SINK", "jsonl")
+USAGE_LOG_DIR     = os.getenv("USAGE_LOG_DIR", ".")
+USAGE_RETENTION_DAYS = int(os.getenv("USAGE_RETENTION_DAYS", "30"))
+
+# bounded: if the sink is down, oldest records are dropped, not RAM
+USAGE_RING = deque(maxlen=USAGE_RING_SIZE)
+_usage_lock = threading.Lock()
+_usage_wake = threading.Event()
+_usage_flusher_pid = None
+_usage_pruned_day = None
+
+def key_id(key):
+    # never store the key itself
+    return hashlib.sha256(key.encode()).hexdigest()[:8]
+
+def current_caller():
+    if not has_request_context():
+        return "internal"
+    ext = getattr(request, "external_user", None)
+    return f"api:{ext['name']}" if ext else "browser"
+
+def usage_day(ts):
+    return time.strftime("%Y%m%d", time.gmtime(ts))
+
+def usage_log_path(day):
+    return os.path.join(USAGE_LOG_DIR, f"upstream_usage-{day}.jsonl")
+
+def record_call(provider, model, key, started, ok, usage=None, attempt=0):
+    """
+    depth is the model fallback index set by generate_ai,
+    key_attempt the key retry index inside one model.
+    """
+    usage = usage or {}
+    rec = {
+        "ts": time.time(),
+        "provider": provider,
+        "model": model,
+        "key_id": key_id(key),
+        "latency_ms": round((time.monotonic() - started) * 1000, 1),
+        "ok": ok,
+        # gemini: usageMetadata, groq: usage
+        "prompt_tokens": usage.get("promptTokenCount", usage.get("prompt_tokens", 0)),
+        "output_tokens": usage.get("candidatesTokenCount", usage.get("completion_tokens", 0)),
+        "depth": g.get("model_depth", 0) if has_request_context() else 0,
+        "key_attempt": attempt,
+        "caller": current_caller(),
+        "path": request.path if has_request_context() else None,
+        "mode": g.get("route_mode") if has_request_context() else None,
+    }
+
+    ROUTER.observe(rec)
+
+    with _usage_lock:
+        USAGE_RING.append(rec)
+        due = len(USAGE_RING) >= USAGE_FLUSH_EVERY
+
+    start_usage_flusher()
+    if due:
+        _usage_wake.set()
+
+def start_usage_flusher():
+    # threads don't survive gunicorn's fork, so start one per worker pid
+    global _usage_flusher_pid
+
+    with _usage_lock:
+        if _usage_flusher_pid == os.getpid():
+            return
+        _usage_flusher_pid = os.getpid()
+
+    threading.Thread(target=_usage_flush_loop, daemon=True).start()
+
+def _usage_flush_loop():
+    while True:
+        _usage_wake.wait(USAGE_FLUSH_SECS)
+        _usage_wake.clear()
+        flush_usage()
+
+def flush_usage():
+    with _usage_lock:
+        batch = list(USAGE_RING)
+        USAGE_RING.clear()
+
+    if not batch:
+        return
+
+    try:
+        if USAGE_SINK == "firestore":
+            # firestore batches are capped at 500 writes
+            for i in range(0, len(batch), 500):
+                wb = db.batch()
+                for rec in batch[i:i + 500]:
+                    wb.set(db.collection("upstream_usage").document(), rec)
+                wb.commit()
+        else:
+            # a batch can straddle midnight
+            days = {}
+            for rec in batch:
+                days.setdefault(usage_day(rec["ts"]), []).append(json_dumps(rec) + b"\n")
+            for day, lines in days.items():
+                with open(usage_log_path(day), "ab") as f:
+                    f.write(b"".join(lines))
+            prune_usage_logs()
+    except Exception as e:
+        print("USAGE FLUSH ERROR:", e)
+
+def prune_usage_logs():
+    """Deletes day files older than USAGE_RETENTION_DAYS, once a day per worker."""
+    global _usage_pruned_day
+
+    today = usage_day(time.time())
+    if _usage_pruned_day == today:
+        return
+    _usage_pruned_day = today
+
+    cutoff = usage_day(time.time() - USAGE_RETENTION_DAYS * 86400)
+    for name in os.listdir(USAGE_LOG_DIR):
+        if name.startswith("upstream_usage-") and name.endswith(".jsonl"):
+            if name[len("upstream_usage-"):-len(".jsonl")] < cutoff:
+                try:
+                    os.remove(os.path.join(USAGE_LOG_DIR, name))
+                except FileNotFoundError:
+                    pass  # another worker got it first
+
+atexit.register(flush_usage)
+
+def load_usage(since):
+    """Streams flushed records (all workers) with ts >= since."""
+    if USAGE_SINK == "firestore":
+        for d in db.collection("upstream_usage").where("ts", ">=", since).stream():
+            yield d.to_dict()
+        return
+
+    # only the day files that overlap [since, now]
+    day = since - since % 86400
+    while day <= time.time():
         try:
-            url = f"https://generativelanguage.googleapis.com/v1beta/models/{model}:generateContent"
+            with open(usage_log_path(usage_day(day)), "rb") as f:
+                for line in f:
+                    try:
+                        rec = json_loads(line)
+                    except ValueError:
+                        continue  # torn line from a concurrent append
+                    if rec["ts"] >= since:
+                        yield rec
+        except FileNotFoundError:
+            pass
+        day += 86400
+
+USAGE_GROUPS = ("model", "key_id", "caller", "depth", "key_attempt")
+
+def summarize_usage(records):
+    """One pass over records, grouped by every field in USAGE_GROUPS."""
+    summary = {field: {} for field in USAGE_GROUPS}
+    count = 0
+
+    for rec in records:
+        count += 1
+        for field in USAGE_GROUPS:
+            # records flushed before key_attempt existed lack the field
+            row = summary[field].setdefault(str(rec.get(field)), {
+                "calls": 0,
+                "errors": 0,
+                "latency_ms": 0.0,
+                "prompt_tokens": 0,
+                "output_tokens": 0,
+            })
+            row["calls"] += 1
+            row["errors"] += not rec["ok"]
+            row["latency_ms"] += rec["latency_ms"]
+            row["prompt_tokens"] += rec["prompt_tokens"]
+            row["output_tokens"] += rec["output_tokens"]
 
-            payload = {
-                "contents": [{
-                    "role": "user",
-                    "parts": [{"text": prompt}]
-                }]
-            }
+    for rows in summary.values():
+        for row in rows.values():
+            row["avg_latency_ms"] = round(row.pop("latency_ms") / row["calls"], 1)
+    return count, summary
 
-            if internet:
-                payload["tools"] = [{"google_search": {}}]
+# -------------------- GEMINI CALL --------------------
+def call_gemini(prompt, model, internet=False):
+    url = gemini_url(model)
+    body = gemini_payload(prompt, internet)
 
-            r = requests.post(
+    for attempt, key in enumerate(random.sample(GEMINI_KEYS, len(GEMINI_KEYS))):
+        started = time.monotonic()
+        try:
+            r = HTTP.post(
                 url,
                 params={"key": key},
-                json=payload,
+                data=body,
+                headers=JSON_HEADERS,
                 timeout=20
             )
             r.raise_for_status()
-            return r.json()["candidates"][0]["content"]["parts"][0]["text"]
+            text, usage = parse_gemini_reply(r.content)
+            record_call("gemini", model, key, started, True, usage, attempt)
+            return text
 
         except Exception:
+            record_call("gemini", model, key, started, False, attempt=attempt)
             continue
     return None
 
 # -------------------- GROQ CALL --------------------
 def call_groq(prompt):
-    for key in random.sample(GROQ_KEYS, len(GROQ_KEYS)):
+    body = groq_payload(prompt)
+
+    for attempt, key in enumerate(random.sample(GROQ_KEYS, len(GROQ_KEYS))):
+        started = time.monotonic()
         try:
-            r = requests.post(
+            r = HTTP.post(
                 "https://api.groq.com/openai/v1/chat/completions",
                 headers={
                     "Authorization": f"Bearer {key}",
                     "Content-Type": "application/json"
                 },
-                json={
-                    "model": "llama-3.1-8b-instant",
-                    "messages": [{"role": "user", "content": prompt}]
-                },
+                data=body,
                 timeout=15
             )
             r.raise_for_status()
-            return r.json()["choices"][0]["message"]["content"]
+            text, usage = parse_groq_reply(r.content)
+            record_call("groq", "llama-3.1-8b-instant", key, started, True, usage, attempt)
+            return text
         except Exception:
+            record_call("groq", "llama-3.1-8b-instant", key, started, False, attempt=attempt)
             continue
     return None
 
+# -------------------- UPLOAD CACHE --------------------
+# Repeat uploads skip PyPDF2 / PIL entirely. Entries are the extracted
+# text or the resized JPEG as base64, keyed by "<sha256>.<kind>" where
+# kind comes from the extension, so the same bytes under another
+# extension are processed (or rejected) as before.
+# Memory tier is a per-process LRU, disk tier is shared by all workers.
+# Both are bounded by size. The disk tier is only used if its directory
+# is private to this user (0700, not a symlink), so nobody else on the
+# box can read uploads or plant entries; files are written 0600.
+UPLOAD_CACHE_MEM_BYTES  = int(os.getenv("UPLOAD_CACHE_MEM_MB", "32")) * 1024 * 1024
+UPLOAD_CACHE_DISK_BYTES = int(os.getenv("UPLOAD_CACHE_DISK_MB", "512")) * 1024 * 1024
+UPLOAD_CACHE_DIR        = os.getenv("UPLOAD_CACHE_DIR", "/tmp/virginai-upload-cache")
+UPLOAD_CHUNK            = 64 * 1024
+UPLOAD_EVICT_EVERY      = 50   # disk puts between eviction sweeps
+SESSION_UPLOADS         = 8    # file_hash refs per session, ~75 cookie bytes each
+
+IMAGE_EXTS = (".jpg", ".jpeg", ".png", ".webp")
+TEXT_EXTS  = (".txt", ".py", ".html", ".css")
+
+_mem_cache = OrderedDict()
+_mem_cache_bytes = 0
+_mem_cache_lock = threading.Lock()
+_disk_puts = 0
+_disk_bytes_since_sweep = 0
+
+def _private_dir(path):
+    try:
+        os.makedirs(path, mode=0o700, exist_ok=True)
+        st = os.lstat(path)
+    except OSError as e:
+        print("UPLOAD CACHE ERROR:", e)
+        return False
+
+    if not stat.S_ISDIR(st.st_mode) or st.st_uid != os.getuid() or st.st_mode & 0o077:
+        print("UPLOAD CACHE: disk tier off,", path, "is not a private directory")
+        return False
+    return True
+
+UPLOAD_CACHE_DISK = _private_dir(UPLOAD_CACHE_DIR)
+
+def upload_kind(filename):
+    if filename.endswith(IMAGE_EXTS):
+        return "img"
+    if filename.endswith(".pdf"):
+        return "pdf"
+    if filename.endswith(TEXT_EXTS):
+        return "txt"
+    return None
+
+def hash_upload(file):
+    """
+    sha256 of the upload, read in chunks from werkzeug's spooled
+    stream (no extra copy), then rewound for the parsers.
+    """
+    h = hashlib.sha256()
+    for chunk in iter(lambda: file.stream.read(UPLOAD_CHUNK), b""):
+        h.update(chunk)
+    file.stream.seek(0)
+    return h.hexdigest()
+
+def is_sha256_hex(s):
+    return len(s) == 64 and all(c in "0123456789abcdef" for c in s)
+
+def _disk_path(cache_key):
+    return os.path.join(UPLOAD_CACHE_DIR, cache_key)
+
+def cache_get(cache_key):
+    with _mem_cache_lock:
+        value = _mem_cache.get(cache_key)
+        if value is not None:
+            _mem_cache.move_to_end(cache_key)
+            return value
+
+    if not UPLOAD_CACHE_DISK:
+        return None
+
+    # plain read: consumers need str for the prompt / JSON body anyway,
+    # so an mmap would only be copied out again
+    try:
+        with open(_disk_path(cache_key), "rb") as f:
+            value = f.read()
+        os.utime(_disk_path(cache_key))  # LRU touch for disk eviction
+    except OSError:
+        return None
+
+    _mem_put(cache_key, value)
+    return value
+
+def _mem_put(cache_key, value):
+    global _mem_cache_bytes
+
+    if len(value) > UPLOAD_CACHE_MEM_BYTES:
+        return
+
+    with _mem_cache_lock:
+        old = _mem_cache.pop(cache_key, None)
+        if old is not None:
+            _mem_cache_bytes -= len(old)
+
+        _mem_cache[cache_key] = value
+        _mem_cache_bytes += len(value)
+
+        while _mem_cache_bytes > UPLOAD_CACHE_MEM_BYTES:
+            _, evicted = _mem_cache.popitem(last=False)
+            _mem_cache_bytes -= len(evicted)
+
+def _disk_evict():
+    entries = []
+    for e in os.scandir(UPLOAD_CACHE_DIR):
+        if e.name.endswith(".tmp"):
+            continue  # another worker's in-flight write
+        try:
+            st = e.stat()
+        except OSError:
+            continue
+        entries.append((st.st_mtime, st.st_size, e.path))
+
+    total = sum(size for _, size, _ in entries)
+    for _, size, path in sorted(entries):
+        if total <= UPLOAD_CACHE_DISK_BYTES:
+            break
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+        total -= size
+
+def cache_put(cache_key, value):
+    global _disk_puts, _disk_bytes_since_sweep
+
+    _mem_put(cache_key, value)
+
+    if not UPLOAD_CACHE_DISK or len(value) > UPLOAD_CACHE_DISK_BYTES:
+        return
+
+    try:
+        # write + rename so other workers never read a half file
+        tmp = f"{_disk_path(cache_key)}.{os.getpid()}.tmp"
+        fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, "wb") as f:
+            f.write(value)
+        os.replace(tmp, _disk_path(cache_key))
+    except OSError as e:
+        print("UPLOAD CACHE ERROR:", e)
+        return
+
+    # sweep every N puts or once 10% of the budget was written,
+    # not a full scandir + stat on every upload
+    with _mem_cache_lock:
+        _disk_puts += 1
+        _disk_bytes_since_sweep += len(value)
+        due = (
+            _disk_puts % UPLOAD_EVICT_EVERY == 0 or
+            _disk_bytes_since_sweep >= UPLOAD_CACHE_DISK_BYTES // 10
+        )
+        if due:
+            _disk_bytes_since_sweep = 0
+
+    if due:
+        _disk_evict()
+
+def remember_upload(digest, kind):
+    """
+    file_hash references are scoped to the session that uploaded the
+    file; the cache itself is shared, but a hash from another user is
+    rejected like an unknown one.
+
+    Stored as a list of [digest, kind], newest last: Flask's session
+    serializer sorts dict keys, so a dict would not keep upload order.
+    """
+    uploads = [u for u in session_uploads() if u[0] != digest]
+    uploads.append([digest, kind])
+    session["uploads"] = uploads[-SESSION_UPLOADS:]
+
+def session_uploads():
+    uploads = session.get("uploads")
+    # sessions from before the list format held a dict: start over
+    return uploads if isinstance(uploads, list) else []
+
+def session_upload_kind(digest):
+    return next((kind for d, kind in session_uploads() if d == digest), None)
+
 #vision model 
 GEMINI_VISION_MODEL = "gemini-2.5-flash"
 
-def call_gemini_vision(file, question):
-    for key in random.sample(GEMINI_KEYS, len(GEMINI_KEYS)):
+def preprocess_image(stream) -> str:
+    img = Image.open(stream).convert("RGB")
+    img = img.resize((768, 768))
+
+    buf = io.BytesIO()
+    img.save(buf, format="JPEG", quality=65)
+    return base64.b64encode(buf.getvalue()).decode()
+
+def call_gemini_vision(img_b64, question):
+    body = json_dumps({
+        "contents": [{
+            "role": "user",
+            "parts": [
+                {"text": question},
+                {
+                    "inline_data": {
+                        "mime_type": "image/jpeg",
+                        "data": img_b64
+                    }
+                }
+            ]
+        }]
+    })
+
+    for attempt, key in enumerate(random.sample(GEMINI_KEYS, len(GEMINI_KEYS))):
+        started = time.monotonic()
         try:
-            img = Image.open(file.stream).convert("RGB")
-            img = img.resize((768, 768))
-
-            buf = io.BytesIO()
-            img.save(buf, format="JPEG", quality=65)
-            img_b64 = base64.b64encode(buf.getvalue()).decode()
-
-            payload = {
-                "contents": [{
-                    "role": "user",
-                    "parts": [
-                        {"text": question},
-                        {
-                            "inline_data": {
-                                "mime_type": "image/jpeg",
-                                "data": img_b64
-                            }
-                        }
-                    ]
-                }]
-            }
-
-            r = requests.post(
-                f"https://generativelanguage.googleapis.com/v1beta/models/{GEMINI_VISION_MODEL}:generateContent",
+            r = HTTP.post(
+                gemini_url(GEMINI_VISION_MODEL),
                 params={"key": key},
-                json=payload,
+                data=body,
+                headers=JSON_HEADERS,
                 timeout=25
             )
             r.raise_for_status()
 
-            return r.json()["candidates"][0]["content"]["parts"][0]["text"]
+            text, usage = parse_gemini_reply(r.content)
+            record_call("gemini", GEMINI_VISION_MODEL, key, started, True, usage, attempt)
+            return text
 
         except Exception as e:
             print("VISION ERROR:", e)
+            record_call("gemini", GEMINI_VISION_MODEL, key, started, False, attempt=attempt)
             continue
 
     return None
 
 #text extract    
-def extract_text_from_file(file):
+def extract_text(name, stream):
     try:
-        name = file.filename.lower()
-
-        if name.endswith(".txt") or name.endswith(".py") or name.endswith(".html") or name.endswith(".css"):
-            return file.read().decode("utf-8", errors="ignore"), None
+        if name.endswith(TEXT_EXTS):
+            return stream.read().decode("utf-8", errors="ignore"), None
 
         if name.endswith(".pdf"):
-            reader = PyPDF2.PdfReader(file.stream)
+            reader = PyPDF2.PdfReader(stream)
             text = "\n".join(page.extract_text() or "" for page in reader.pages)
             return text[:8000], None  # context safe
 
@@ -354,79 +743,54 @@ def extract_text_from_file(file):
 # -------------------- AI ROUTER --------------------
 def generate_ai(prompt, mode):
     """
-    MODE BEHAVIOR SUMMARY:
+    MODE TIERS (see router.ROUTES):
 
     smart:
-        → Gemini: gemma-3-27b-it
-        → if fails → Groq: llama-3.1-8b-instant
+        → gemma-3-4b-it | Groq llama-3.1-8b-instant
 
     internet:
         → Gemini with Google Search tool:
-            - gemini-3-flash-preview
-            - gemini-2.5-flash-lite
-        → if all fail → smart model
-        → if still fail → Groq
+            gemini-3-flash-preview | gemini-2.5-flash-lite
+        → if all fail → smart tier
 
     think:
-        → Gemini reasoning model:
-            - gemini-3-flash-think
-        → if fails → smart model
+        → gemini-3-flash-think
+        → if fails → gemma-3-27b-it
         → if still fail → Groq
 
     flash:
-        → Groq (fastest & cheapest):
-            - llama-3.1-8b-instant
-        → if Groq fails → smart model
+        → Groq llama-3.1-8b-instant | gemma-3-1b-it
+
+    Tiers are tried in order. Inside a tier ("|") the router ranks
+    models by prompt size, live latency, error rate and key headroom.
+    Unknown modes use smart.
     """
+    tokens = router.estimate_tokens(prompt)
+    tiers, why = ROUTER.plan(mode, tokens)
 
-    # ---------- helper: try Gemini ----------
-    def try_gemini(model, internet=False):
-        reply = call_gemini(prompt, model, internet)
-        return (reply, model) if reply else (None, None)
-
-    # ---------- helper: try Groq ----------
-    def try_groq():
-        reply = call_groq(prompt)
-        return (reply, "llama-3.1-8b-instant") if reply else (None, None)
-
-    # ---------------- SMART MODE ----------------
-    # Default mode for normal chat
-    if mode == "smart":
-        reply, model = try_gemini("gemma-3-4b-it")
-        return (reply, model) if reply else try_groq()
-
-    # ---------------- INTERNET MODE ----------------
-    # Enables Google search tool inside Gemini
-    if mode == "internet":
-        for m in MODELS["internet"]:
-            reply, model = try_gemini(m, internet=True)
-            if reply:
-                return reply, model
+    in_request = has_request_context()
+    if in_request:
+        g.route_mode = mode
 
-        # fallback chain: smart → groq
-        reply, model = try_gemini("gemma-3-4b-it")
-        return (reply, model) if reply else try_groq()
+    if why:
+        print("ROUTE:", mode, f"{tokens} tok", "|", "; ".join(why))
 
-    # ---------------- THINK MODE ----------------
-    # Pure reasoning, no tools
-    if mode == "think":
-        reply, model = try_gemini("gemini-3-flash-think")
-        if reply:
-            return reply, model
+    depth = 0
+    for tier in tiers:
+        for model, internet in tier:
+            if in_request:
+                g.model_depth = depth  # read by record_call
+            depth += 1
 
-        reply, model = try_gemini("gemma-3-27b-it")
-        return (reply, model) if reply else try_groq()
+            if router.provider_of(model) == "groq":
+                reply = call_groq(prompt)
+            else:
+                reply = call_gemini(prompt, model, internet)
 
-    # ---------------- FLASH MODE ----------------
-    # Fastest responses (Groq)
-    if mode == "flash":
-        reply, model = try_groq()
-        return (reply, model) if reply else try_gemini("gemma-3-1b-it")
+            if reply:
+                return reply, model
 
-    # ---------------- UNKNOWN MODE ----------------
-    # Safety fallback
-    reply, model = try_gemini("gemma-3-4b-it")
-    return (reply, model) if reply else try_groq()
+    return None, None
 
 
 #about virginai 
@@ -542,17 +906,56 @@ def ask():
 @app.route("/upload", methods=["POST"])
 @limiter.limit("5 per minute")
 def upload():
+    """
+    multipart: file + question
+    or form:   file_hash (from a previous upload in the same session) + question
+    """
     try:
-        if "file" not in request.files:
-            return jsonify({"answer": "❗ No file uploaded"}), 400
-
-        file = request.files["file"]
         question = request.form.get("question", "Explain this")
-        filename = file.filename.lower()
+        file = request.files.get("file")
+
+        # ---------- REFERENCE BY HASH (own session only) ----------
+        if file is None:
+            digest = request.form.get("file_hash", "").lower()
+            if not digest:
+                return jsonify({"answer": "❗ No file uploaded"}), 400
+
+            kind = session_upload_kind(digest)
+            cached = cache_get(f"{digest}.{kind}") if kind and is_sha256_hex(digest) else None
+            if cached is None:
+                return jsonify({"answer": "❗ File expired, please upload again"}), 404
+
+        # ---------- NEW / REPEAT UPLOAD ----------
+        else:
+            filename = file.filename.lower()
+            kind = upload_kind(filename)
+            if kind is None:
+                return jsonify({"answer": "❗ Unsupported file type"}), 400
+
+            digest = hash_upload(file)
+            cached = cache_get(f"{digest}.{kind}")
+
+            if cached is None:
+                if kind == "img":
+                    try:
+                        cached = preprocess_image(file.stream).encode()
+                    except Exception as e:
+                        print("VISION ERROR:", e)
+                        return jsonify({"answer": "❌ File processing failed"}), 400
+                else:
+                    extracted_text, error = extract_text(filename, file.stream)
+                    if error:
+                        return jsonify({"answer": error}), 400
+                    cached = extracted_text.encode()
+
+                cache_put(f"{digest}.{kind}", cached)
+
+        remember_upload(digest, kind)
+        payload = cached.decode()
 
         # ---------- IMAGE → GEMINI VISION ----------
-        if filename.endswith((".jpg", ".jpeg", ".png", ".webp")):
-            answer = call_gemini_vision(file, question)
+        if kind == "img":
+            answer = call_gemini_vision(payload, question)
 
             if not answer:
                 return jsonify({"answer": "⚠️ Vision model busy"}), 503
@@ -560,17 +963,14 @@ def upload():
             return jsonify({
                 "answer": answer,
                 "model_used": "gemini-2.5-flash",
-                "source": "image"
+                "source": "image",
+                "file_hash": digest
             })
 
         # ---------- TEXT / PDF → SMART MODE ----------
-        extracted_text, error = extract_text_from_file(file)
-        if error:
-            return jsonify({"answer": error}), 400
-
         prompt = f"""
 User uploaded document:
-{extracted_text}
+{payload}
 
 User question:
 {question}
@@ -584,7 +984,8 @@ User question:
         return jsonify({
             "answer": reply,
             "model_used": model_used,
-            "source": "file"
+            "source": "file",
+            "file_hash": digest
         })
 
     except Exception as e:
@@ -746,6 +1147,36 @@ def send_user_notification():
 
 
 
+# -------------------- UPSTREAM USAGE SUMMARY --------------------
+@app.route("/admin/usage-summary", methods=["GET"])
+@limiter.limit("10 per minute")
+def usage_summary():
+    admin_token = os.getenv("ADMIN_PUSH_TOKEN")
+    if not admin_token or request.headers.get("X-Admin-Token") != admin_token:
+        return jsonify({"error": "Unauthorized"}), 401
+
+    try:
+        hours = float(request.args.get("hours", 24))
+    except ValueError:
+        return jsonify({"error": "hours must be a number"}), 400
+
+    # records still buffered in other workers show up after their next flush
+    flush_usage()
+    since = time.time() - hours * 3600
+    count, summary = summarize_usage(load_usage(since))
+
+    return jsonify({
+        "records": count,
+        "since": since,
+        "sink": USAGE_SINK,
+        "by_model": summary["model"],
+        "by_key": summary["key_id"],
+        "by_caller": summary["caller"],
+        "by_depth": summary["depth"],
+        "by_key_attempt": summary["key_attempt"],
+    })
+
+
 # -------------------- CLEAR SESSION --------------------
 @app.route("/clear-session", methods=["POST"])
 def clear_session():
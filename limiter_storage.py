@@ -0,0 +1,312 @@
+"""
+Node-local rate limit storage shared by all gunicorn workers.
+
+flask-limiter's default memory:// storage is per process, so N workers
+allow N x "30 per minute" and forget everything on restart. This
+registers a ``sqlite://`` scheme with ``limits``: one WAL-mode SQLite
+file (in /dev/shm by default, so it never touches disk) that every
+worker on the node opens. A check is a single SQL statement.
+
+Every write serialises on SQLite's one write lock. SQLite's own busy
+handler backs off in sleeps of up to 100 ms, so it is disabled: a
+check retries with short sleeps for at most LOCK_BUDGET
+(RATELIMIT_LOCK_BUDGET_MS, default 50 ms) and then fails closed: the
+request is rejected as over the limit and counted in
+``lock_timeouts``, so flooding the lock cannot bypass the limits.
+A sliding-window check is one INSERT ... SELECT ... WHERE statement,
+so the lock is only held inside SQLite with the GIL released.
+
+Tail latency is not sub-millisecond under contention: it is bounded
+by LOCK_BUDGET plus however long the OS (or, with threaded workers,
+the 5 ms GIL switch interval) keeps the waiting thread off the CPU.
+Measure on the target box with the benchmark below; any ``lock
+timeouts`` mean real users were rejected and the node needs fewer
+workers per core or a larger budget.
+
+The database is created 0600 (SQLite gives its -wal / -shm files the
+same mode) and is refused if another user owns it or can open it, so
+a file pre-planted in the shared /dev/shm cannot be used to tamper
+with the counters.
+
+Supports the fixed-window and sliding-window-counter strategies:
+
+    Limiter(..., storage_uri="sqlite:////dev/shm/virginai-limits.db",
+            strategy="sliding-window-counter")
+
+Benchmark check overhead under concurrency:
+
+    python limiter_storage.py [processes] [threads] [checks]
+"""
+
+import os, sqlite3, threading, time
+
+from limits.storage import Storage
+from limits.storage.base import SlidingWindowCounterSupport, TimestampedSlidingWindow
+
+PURGE_EVERY  = 1000    # writes between expired-row sweeps
+LOCK_BUDGET  = float(os.getenv("RATELIMIT_LOCK_BUDGET_MS", "50")) / 1000
+LOCK_SPIN    = 0.00005 # sleep between lock attempts
+SETUP_BUDGET = 5.0     # schema creation / reset / clear may wait longer
+OVER_LIMIT   = 2 ** 62 # incr() result on lock timeout, above any limit
+
+
+class LockBusy(Exception):
+    """Write lock not acquired within the budget."""
+
+def default_uri():
+    base = "/dev/shm" if os.path.isdir("/dev/shm") else "/tmp"
+    # per user, so another account's file never blocks startup
+    return f"sqlite:///{base}/virginai-limits-{os.getuid()}.db"
+
+def _check_private(path, create=False):
+    """Raises PermissionError unless path is ours and owner-only."""
+    flags = os.O_RDWR | os.O_NOFOLLOW | (os.O_CREAT if create else 0)
+    try:
+        fd = os.open(path, flags, 0o600)
+    except FileNotFoundError:
+        return
+    try:
+        st = os.fstat(fd)
+    finally:
+        os.close(fd)
+    if st.st_uid != os.getuid() or st.st_mode & 0o077:
+        raise PermissionError(f"{path} must be owned by this user with mode 0600")
+
+
+class SQLiteStorage(Storage, SlidingWindowCounterSupport, TimestampedSlidingWindow):
+    STORAGE_SCHEME = ["sqlite"]
+
+    def __init__(self, uri=None, wrap_exceptions=False, **options):
+        # sqlite:////dev/shm/x.db → /dev/shm/x.db
+        self.path = uri.split("://", 1)[1][1:] if uri else default_uri()[10:]
+        self._local = threading.local()
+        self._writes = 0
+        self.lock_timeouts = 0
+        super().__init__(uri, wrap_exceptions=wrap_exceptions, **options)
+
+        _check_private(self.path, create=True)
+        for suffix in ("-wal", "-shm"):
+            _check_private(self.path + suffix)
+
+        self._write(
+            "CREATE TABLE IF NOT EXISTS counters ("
+            " key TEXT PRIMARY KEY,"
+            " value INTEGER NOT NULL,"
+            " expiry REAL NOT NULL"
+            ") WITHOUT ROWID",
+            budget=SETUP_BUDGET,
+        )
+
+    @property
+    def base_exceptions(self):
+        return sqlite3.Error
+
+    # ---------- connection per thread, reopened after fork ----------
+    def _conn(self):
+        local = self._local
+        if getattr(local, "pid", None) != os.getpid():
+            db = sqlite3.connect(self.path, timeout=SETUP_BUDGET, isolation_level=None,
+                                 check_same_thread=False)
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute("PRAGMA synchronous=OFF")
+            # no SQLite busy handler for checks, _write does its own waiting
+            db.execute("PRAGMA busy_timeout=0")
+            local.db, local.pid = db, os.getpid()
+        return local.db
+
+    def _write(self, sql, params=(), budget=LOCK_BUDGET):
+        """
+        Runs one autocommit statement. Each check is a single statement
+        so the write lock is only held inside SQLite (GIL released),
+        never across Python code where a thread switch could stall it.
+        """
+        db = self._conn()
+        deadline = time.perf_counter() + budget
+        while True:
+            try:
+                # fetchall steps to the end, so the implicit txn commits now
+                cur = db.execute(sql, params)
+                return cur.fetchall() if cur.description else cur.rowcount
+            except sqlite3.OperationalError as e:
+                if "locked" not in str(e) and "busy" not in str(e):
+                    raise
+                if time.perf_counter() >= deadline:
+                    raise LockBusy() from e
+                time.sleep(LOCK_SPIN)
+
+    def _purge(self, now):
+        self._writes += 1
+        if self._writes % PURGE_EVERY == 0:
+            try:
+                self._write("DELETE FROM counters WHERE expiry <= ?", (now,))
+            except LockBusy:
+                pass  # next sweep will get it
+
+    def _get(self, key, now):
+        # WAL readers never wait on the writer
+        row = self._conn().execute(
+            "SELECT value FROM counters WHERE key = ? AND expiry > ?", (key, now)
+        ).fetchone()
+        return row[0] if row else 0
+
+    # ---------- Storage ----------
+    def incr(self, key, expiry, elastic_expiry=False, amount=1):
+        # elastic_expiry: limits 4.x passes it, 5.x dropped it
+        now = time.time()
+        try:
+            rows = self._write(
+                "INSERT INTO counters (key, value, expiry) VALUES (?1, ?2, ?3) "
+                "ON CONFLICT (key) DO UPDATE SET "
+                " value  = CASE WHEN expiry > ?4 THEN value + ?2 ELSE ?2 END,"
+                " expiry = CASE WHEN expiry > ?4 AND NOT ?5 THEN expiry ELSE ?3 END "
+                "RETURNING value",
+                (key, amount, now + expiry, now, elastic_expiry),
+            )
+        except LockBusy:
+            self.lock_timeouts += 1
+            return OVER_LIMIT
+
+        self._purge(now)
+        return rows[0][0]
+
+    def get(self, key):
+        return self._get(key, time.time())
+
+    def get_expiry(self, key):
+        now = time.time()
+        row = self._conn().execute(
+            "SELECT expiry FROM counters WHERE key = ? AND expiry > ?", (key, now)
+        ).fetchone()
+        return row[0] if row else now
+
+    def check(self):
+        try:
+            self._conn().execute("SELECT 1").fetchone()
+            return True
+        except sqlite3.Error:
+            return False
+
+    def reset(self):
+        n = self._conn().execute("SELECT COUNT(*) FROM counters").fetchone()[0]
+        self._write("DELETE FROM counters", budget=SETUP_BUDGET)
+        return n
+
+    def clear(self, key):
+        self._write("DELETE FROM counters WHERE key = ?", (key,), budget=SETUP_BUDGET)
+
+    # ---------- SlidingWindowCounterSupport ----------
+    @staticmethod
+    def _ttls(expiry, now):
+        # same TTL math as limits' MemoryStorage
+        previous_ttl = (1 - (((now - expiry) / expiry) % 1)) * expiry
+        current_ttl = (1 - ((now / expiry) % 1)) * expiry + expiry
+        return previous_ttl, current_ttl
+
+    def acquire_sliding_window_entry(self, key, limit, expiry, amount=1):
+        if amount > limit:
+            return False
+
+        now = time.time()
+        previous_key, current_key = self.sliding_window_keys(key, expiry, now)
+        previous_ttl, _ = self._ttls(expiry, now)
+
+        # check + increment in one statement: the row is only written
+        # when floor(prev * prev_ttl / expiry + current) + amount <= limit
+        try:
+            changed = self._write(
+                "INSERT INTO counters (key, value, expiry) "
+                "SELECT ?1, ?2, ?3 WHERE CAST("
+                " COALESCE((SELECT value FROM counters WHERE key = ?5 AND expiry > ?4), 0) * ?6 +"
+                " COALESCE((SELECT value FROM counters WHERE key = ?1 AND expiry > ?4), 0)"
+                " AS INTEGER) + ?2 <= ?7 "
+                "ON CONFLICT (key) DO UPDATE SET "
+                " value  = CASE WHEN expiry > ?4 THEN value + ?2 ELSE ?2 END,"
+                " expiry = CASE WHEN expiry > ?4 THEN expiry ELSE ?3 END",
+                # no RETURNING: a plain INSERT commits inside one step, while
+                # RETURNING keeps the txn open until Python fetches the rows
+                # current window key lives for two windows, it becomes "previous"
+                (current_key, amount, now + 2 * expiry, now,
+                 previous_key, previous_ttl / expiry, limit),
+            )
+        except LockBusy:
+            self.lock_timeouts += 1
+            return False
+
+        self._purge(now)
+        return changed > 0
+
+    def get_sliding_window(self, key, expiry):
+        now = time.time()
+        previous_key, current_key = self.sliding_window_keys(key, expiry, now)
+        previous_count = self._get(previous_key, now)
+        current_count = self._get(current_key, now)
+        previous_ttl, current_ttl = self._ttls(expiry, now)
+        return (
+            previous_count,
+            previous_ttl if previous_count else 0.0,
+            current_count,
+            current_ttl,
+        )
+
+    def clear_sliding_window(self, key, expiry):
+        now = time.time()
+        previous_key, current_key = self.sliding_window_keys(key, expiry, now)
+        self._write(
+            "DELETE FROM counters WHERE key IN (?, ?)",
+            (previous_key, current_key),
+            budget=SETUP_BUDGET,
+        )
+
+
+# -------------------- BENCHMARK --------------------
+def _bench_worker(uri, threads, checks, out):
+    storage = SQLiteStorage(uri)
+    timings = []
+
+    def run():
+        for i in range(checks):
+            started = time.perf_counter()
+            storage.acquire_sliding_window_entry(f"bench/{i % 50}", 30, 60)
+            timings.append(time.perf_counter() - started)
+
+    pool = [threading.Thread(target=run) for _ in range(threads)]
+    for t in pool:
+        t.start()
+    for t in pool:
+        t.join()
+    out.put((timings, storage.lock_timeouts))
+
+
+if __name__ == "__main__":
+    import sys, tempfile, multiprocessing
+
+    args = [int(a) for a in sys.argv[1:4]]
+    procs, threads, checks = args + [4, 1, 2000][len(args):]
+
+    shm = "/dev/shm" if os.path.isdir("/dev/shm") else None
+    with tempfile.TemporaryDirectory(dir=shm) as tmp:
+        uri = f"sqlite:///{tmp}/bench.db"
+        SQLiteStorage(uri).reset()
+
+        out = multiprocessing.Queue()
+        workers = [
+            multiprocessing.Process(target=_bench_worker, args=(uri, threads, checks, out))
+            for _ in range(procs)
+        ]
+        started = time.perf_counter()
+        for w in workers:
+            w.start()
+        results = [out.get() for _ in workers]
+        for w in workers:
+            w.join()
+        wall = time.perf_counter() - started
+
+    timings = sorted(t for ts, _ in results for t in ts)
+    timeouts = sum(n for _, n in results)
+
+    def pct(p):
+        return timings[min(int(len(timings) * p), len(timings) - 1)] * 1e6
+
+    print(f"{procs} procs x {threads} threads, {len(timings)} checks in {wall:.2f}s")
+    print(f"p50 {pct(0.50):.0f}us  p99 {pct(0.99):.0f}us  p99.9 {pct(0.999):.0f}us  "
+          f"max {timings[-1] * 1e6:.0f}us  lock timeouts {timeouts}")
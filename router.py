@@ -0,0 +1,293 @@
+"""
+Adaptive model router for generate_ai.
+
+Each mode has an ordered list of quality tiers. Tiers are tried in
+order (same fallback chain as before); inside a tier candidates are
+ranked by estimated cost:
+
+    est_ms  = base latency + prompt_tokens / 1000 * ms per 1k tokens
+    cost    = est_ms / (1 - error rate), x10 if every key is cooling down
+
+Stats are EWMAs fed from app.record_call(), so no extra bookkeeping.
+Sample weight halves every STALE_HALF_LIFE seconds; a model with less
+than MIN_SAMPLES of weight is treated optimistically (cost 0) so it
+gets measured, and EXPLORE_RATE of requests probe a random candidate,
+so a model that was slow or failing once is not written off forever.
+
+Kept free of Flask / Firebase imports so it can replay recorded
+traffic offline:
+
+    python router.py upstream_usage-*.jsonl
+"""
+
+import glob, json, random, sys, threading, time
+
+# -------------------- ROUTES --------------------
+# mode → tiers → (model, internet)
+ROUTES = {
+    "smart": [
+        [("gemma-3-4b-it", False), ("llama-3.1-8b-instant", False)],
+    ],
+    "internet": [
+        [("gemini-3-flash-preview", True), ("gemini-2.5-flash-lite", True)],
+        [("gemma-3-4b-it", False), ("llama-3.1-8b-instant", False)],
+    ],
+    "think": [
+        [("gemini-3-flash-think", False)],
+        [("gemma-3-27b-it", False)],
+        [("llama-3.1-8b-instant", False)],
+    ],
+    "flash": [
+        [("llama-3.1-8b-instant", False), ("gemma-3-1b-it", False)],
+    ],
+}
+
+GROQ_MODELS = {"llama-3.1-8b-instant"}
+
+# prompts above this go to the back of their tier
+MAX_PROMPT_TOKENS = {
+    "gemma-3-1b-it": 32000,
+}
+DEFAULT_MAX_PROMPT_TOKENS = 128000
+
+PRIOR_MS        = 2000.0   # used until a model has base latency samples
+PRIOR_MS_PER_1K = 400.0
+PRIOR_ERR       = 0.05     # err EWMA starts here, not at the first sample
+SMALL_PROMPT    = 500      # below this a call measures base latency
+EWMA_ALPHA      = 0.2
+KEY_COOLDOWN    = 60       # seconds a failed key counts as used up
+MIN_SAMPLES     = 5        # below this a model is explored first
+STALE_HALF_LIFE = 600      # seconds for a model's sample weight to halve
+EXPLORE_RATE    = 0.05     # share of requests that probe a random candidate
+
+
+def provider_of(model):
+    return "groq" if model in GROQ_MODELS else "gemini"
+
+
+def estimate_tokens(text):
+    # ~4 chars per token for English, good enough for ranking
+    return len(text) // 4 + 1
+
+
+def _ewma(old, new):
+    return new if old is None else old + EWMA_ALPHA * (new - old)
+
+
+class Router:
+    def __init__(self, adaptive=True, explore_rate=EXPLORE_RATE, rng=None):
+        self.adaptive = adaptive
+        self.explore_rate = explore_rate
+        self.rng = rng or random.Random()
+        self.stats = {}          # model → {"n", "ts", "base_ms", "ms_per_1k", "err"}
+        self.key_failed = {}     # (provider, key_id) → ts of last failure
+        self.key_count = {}      # provider → number of configured keys
+        self._lock = threading.Lock()
+
+    def set_key_count(self, provider, n):
+        self.key_count[provider] = n
+
+    @staticmethod
+    def _weight(s, now):
+        """Sample count, halved every STALE_HALF_LIFE since last seen."""
+        return s["n"] * 0.5 ** (max(now - s["ts"], 0) / STALE_HALF_LIFE)
+
+    # ---------- learning ----------
+    def observe(self, rec):
+        """Feed one app.record_call() record."""
+        with self._lock:
+            s = self.stats.setdefault(rec["model"], {
+                "n": 0.0,
+                "ts": rec["ts"],
+                "base_ms": None,
+                "ms_per_1k": None,
+                "err": PRIOR_ERR,
+            })
+            s["n"] = self._weight(s, rec["ts"]) + 1
+            s["ts"] = rec["ts"]
+            s["err"] = _ewma(s["err"], 0.0 if rec["ok"] else 1.0)
+
+            key = (rec["provider"], rec["key_id"])
+            if not rec["ok"]:
+                self.key_failed[key] = rec["ts"]
+                return
+            self.key_failed.pop(key, None)
+
+            tokens = rec["prompt_tokens"]
+            if tokens < SMALL_PROMPT:
+                s["base_ms"] = _ewma(s["base_ms"], rec["latency_ms"])
+            else:
+                base = s["base_ms"] if s["base_ms"] is not None else PRIOR_MS
+                per_1k = max(rec["latency_ms"] - base, 0.0) / tokens * 1000
+                s["ms_per_1k"] = _ewma(s["ms_per_1k"], per_1k)
+
+    # ---------- estimation ----------
+    def headroom(self, provider, now=None):
+        """Fraction of keys not failed within KEY_COOLDOWN."""
+        total = self.key_count.get(provider)
+        if not total:
+            return 1.0
+        now = now or time.time()
+        cooling = sum(
+            1 for (p, _), ts in self.key_failed.items()
+            if p == provider and now - ts < KEY_COOLDOWN
+        )
+        return max(total - cooling, 0) / total
+
+    def estimate(self, model, tokens, now=None):
+        """Returns (cost, est_ms, err, explore)."""
+        now = now or time.time()
+        s = self.stats.get(model)
+        if tokens > MAX_PROMPT_TOKENS.get(model, DEFAULT_MAX_PROMPT_TOKENS):
+            return float("inf"), 0.0, 0.0, False
+        if s is None or self._weight(s, now) < MIN_SAMPLES:
+            # optimistic: unmeasured or stale models go first to get data
+            return 0.0, PRIOR_MS, s["err"] if s else PRIOR_ERR, True
+
+        base, per_1k = s["base_ms"], s["ms_per_1k"]
+        est_ms = (
+            (base if base is not None else PRIOR_MS) +
+            tokens / 1000 * (per_1k if per_1k is not None else PRIOR_MS_PER_1K)
+        )
+        err = s["err"]
+
+        cost = est_ms / max(1.0 - err, 0.05)
+        if self.headroom(provider_of(model), now) == 0:
+            cost *= 10
+        return cost, est_ms, err, False
+
+    # ---------- routing ----------
+    def plan(self, mode, tokens, now=None):
+        """
+        Returns (tiers, why). Static policy keeps list order;
+        adaptive sorts each tier by cost (stable, so ties keep it)
+        and sometimes moves a random usable candidate to the front.
+        """
+        tiers = ROUTES.get(mode, ROUTES["smart"])
+        if not self.adaptive:
+            return tiers, []
+
+        ranked, why = [], []
+        with self._lock:
+            for tier in tiers:
+                scored = [(self.estimate(m, tokens, now), (m, net)) for m, net in tier]
+                scored.sort(key=lambda x: x[0][0])
+
+                usable = [i for i, (est, _) in enumerate(scored) if est[0] != float("inf")]
+                if len(usable) > 1 and self.rng.random() < self.explore_rate:
+                    scored.insert(0, scored.pop(self.rng.choice(usable[1:])))
+                    why.append("probe")
+
+                ranked.append([c for _, c in scored])
+                why.extend(
+                    f"{m}: unmeasured" if explore else f"{m}: ~{est:.0f}ms err={err:.2f}"
+                    for (_, est, err, explore), (m, _) in scored
+                )
+        return ranked, why
+
+
+# -------------------- OFFLINE REPLAY --------------------
+class Observed:
+    """
+    Held-out ground truth: empirical latency / error rate per
+    (model, small-or-large prompt), falling back to the model overall.
+    """
+
+    def __init__(self, records):
+        self.sums = {}
+        for rec in records:
+            for k in ((rec["model"], rec["prompt_tokens"] >= SMALL_PROMPT), (rec["model"], None)):
+                row = self.sums.setdefault(k, [0, 0, 0.0])  # calls, errors, ok latency
+                row[0] += 1
+                row[1] += not rec["ok"]
+                row[2] += rec["latency_ms"] if rec["ok"] else 0.0
+
+    def outcome(self, model, tokens):
+        """(latency_ms, err) or None if the model never ran in this split."""
+        row = self.sums.get((model, tokens >= SMALL_PROMPT)) or self.sums.get((model, None))
+        if not row:
+            return None
+        calls, errors, latency = row
+        ok = calls - errors
+        return (latency / ok if ok else 0.0), errors / calls
+
+
+def score_chain(tiers, tokens, observed):
+    """Expected latency and failure of walking the whole fallback chain."""
+    reach, latency, unscored = 1.0, 0.0, 0
+    for tier in tiers:
+        for model, _ in tier:
+            out = observed.outcome(model, tokens)
+            if out is None:
+                unscored += 1
+                continue
+            lat, err = out
+            latency += reach * lat
+            reach *= err
+    return latency, reach, unscored
+
+
+def replay(records, policies, train_share=0.5):
+    """
+    Time-split replay: policies learn from the first train_share of
+    recorded calls, then are frozen and each routed request start
+    (first model, first key, with a mode) in the rest is scored
+    against latency and error rates *observed* in that held-out part,
+    following the policy's full fallback chain. Off-policy: models a
+    policy picks but that never ran in the test split are counted as
+    unscored.
+
+    Frozen means planned as of the last training record with probes
+    off; planning at each test timestamp would let the stats decay
+    until every model is "unmeasured" and ranked in static order.
+    """
+    records = sorted(records, key=lambda r: r["ts"])
+    cut = int(len(records) * train_share)
+    train, test = records[:cut], records[cut:]
+    observed = Observed(test)
+    frozen_at = train[-1]["ts"] if train else None
+
+    keys = {}
+    for rec in train:
+        keys.setdefault(rec["provider"], set()).add(rec["key_id"])
+
+    results = {}
+    for name, router in policies.items():
+        for provider, ids in keys.items():
+            router.set_key_count(provider, len(ids))
+        for rec in train:
+            router.observe(rec)
+        router.explore_rate = 0.0
+
+        row = {"requests": 0, "latency_ms": 0.0, "fail": 0.0, "unscored": 0}
+        for rec in test:
+            if not (rec.get("mode") and rec.get("depth") == 0
+                    and rec.get("key_attempt", 0) == 0):
+                continue
+            tokens = rec["prompt_tokens"] or SMALL_PROMPT
+            tiers, _ = router.plan(rec["mode"], tokens, frozen_at)
+            latency, fail, unscored = score_chain(tiers, tokens, observed)
+
+            row["requests"] += 1
+            row["latency_ms"] += latency
+            row["fail"] += fail
+            row["unscored"] += unscored
+
+        n = row["requests"] or 1
+        row["avg_latency_ms"] = round(row.pop("latency_ms") / n, 1)
+        row["avg_fail"] = round(row.pop("fail") / n, 4)
+        results[name] = row
+    return results
+
+
+if __name__ == "__main__":
+    paths = sys.argv[1:] or sorted(glob.glob("upstream_usage-*.jsonl"))
+    records = []
+    for path in paths:
+        with open(path) as f:
+            records.extend(json.loads(line) for line in f if line.strip())
+
+    print(json.dumps(replay(records, {
+        "static": Router(adaptive=False),
+        "adaptive": Router(rng=random.Random(0)),
+    }), indent=2))
@@ -0,0 +1,145 @@
+"""
+JSON encode / decode for Gemini and Groq calls.
+
+Kept free of Flask / Firebase imports so the CPU cost of the upstream
+wire format can be measured on its own:
+
+    python upstream_json.py [iterations]
+
+compares the old path (requests' json= + r.json()) with json_dumps +
+parse_gemini_reply on an 8k-char prompt and a grounding-sized reply.
+"""
+
+import json, time
+
+# -------------------- FAST JSON --------------------
+# orjson is optional: ~5-10x faster dumps/loads, falls back to stdlib json.
+# Lone surrogates (valid JSON input, invalid UTF-8) can't be encoded raw,
+# so those payloads fall back to \uXXXX escapes like requests' json= did.
+try:
+    import orjson
+
+    def json_dumps(obj) -> bytes:
+        try:
+            return orjson.dumps(obj)
+        except TypeError:
+            return json.dumps(obj, separators=(",", ":")).encode()
+
+    json_loads = orjson.loads
+
+except ImportError:
+    # ASCII output: the C encoder's fast path, and surrogates are escaped
+    def json_dumps(obj) -> bytes:
+        return json.dumps(obj, separators=(",", ":")).encode()
+
+    json_loads = json.loads
+
+# -------------------- PAYLOADS --------------------
+def gemini_payload(prompt, internet=False) -> bytes:
+    payload = {
+        "contents": [{
+            "role": "user",
+            "parts": [{"text": prompt}]
+        }]
+    }
+    if internet:
+        payload["tools"] = [{"google_search": {}}]
+    return json_dumps(payload)
+
+def groq_payload(prompt, model="llama-3.1-8b-instant") -> bytes:
+    return json_dumps({
+        "model": model,
+        "messages": [{"role": "user", "content": prompt}]
+    })
+
+def gemini_url(model):
+    return f"https://generativelanguage.googleapis.com/v1beta/models/{model}:generateContent"
+
+# -------------------- REPLY PARSING --------------------
+def parse_gemini_reply(raw: bytes):
+    """
+    Returns (text, usage) from a generateContent reply.
+    Parses raw bytes directly (skips requests' charset sniffing)
+    and ignores groundingMetadata / safetyRatings.
+    """
+    data = json_loads(raw)
+    text = data["candidates"][0]["content"]["parts"][0]["text"]
+    return text, data.get("usageMetadata") or {}
+
+def parse_groq_reply(raw: bytes):
+    data = json_loads(raw)
+    return data["choices"][0]["message"]["content"], data.get("usage") or {}
+
+
+# -------------------- BENCHMARK --------------------
+def _grounded_reply(chunks=60):
+    """A generateContent reply shaped like an internet-mode answer."""
+    answer = "Grounded answer paragraph with citations. " * 80
+    return json.dumps({
+        "candidates": [{
+            "content": {"role": "model", "parts": [{"text": answer}]},
+            "finishReason": "STOP",
+            "safetyRatings": [
+                {"category": f"HARM_CATEGORY_{i}", "probability": "NEGLIGIBLE"}
+                for i in range(4)
+            ],
+            "groundingMetadata": {
+                "webSearchQueries": [f"query {i}" for i in range(5)],
+                "searchEntryPoint": {"renderedContent": "<style>.x{}</style>" * 400},
+                "groundingChunks": [
+                    {"web": {"uri": f"https://vertexaisearch.example/redirect/{i}" + "A" * 200,
+                             "title": f"source-{i}.example.com"}}
+                    for i in range(chunks)
+                ],
+                "groundingSupports": [
+                    {"segment": {"startIndex": i * 40, "endIndex": i * 40 + 39,
+                                 "text": "Grounded answer paragraph with citations."},
+                     "groundingChunkIndices": [i % chunks, (i + 1) % chunks],
+                     "confidenceScores": [0.91, 0.72]}
+                    for i in range(chunks * 2)
+                ],
+            },
+        }],
+        "usageMetadata": {"promptTokenCount": 2100, "candidatesTokenCount": 800,
+                          "totalTokenCount": 2900},
+        "modelVersion": "gemini-2.5-flash-lite",
+    }).encode()
+
+
+def _old_path(prompt, raw):
+    # what requests.post(json=payload) + r.json() did per call
+    payload = {"contents": [{"role": "user", "parts": [{"text": prompt}]}],
+               "tools": [{"google_search": {}}]}
+    try:
+        import requests
+        requests.Request("POST", "http://x/", json=payload).prepare()
+        resp = requests.Response()
+        resp._content, resp.encoding = raw, None
+        data = resp.json()
+    except ImportError:
+        json.dumps(payload, allow_nan=False).encode("utf-8")
+        data = json.loads(raw.decode("utf-8"))
+    return data["candidates"][0]["content"]["parts"][0]["text"]
+
+
+def _new_path(prompt, raw):
+    gemini_payload(prompt, internet=True)
+    return parse_gemini_reply(raw)[0]
+
+
+if __name__ == "__main__":
+    import sys
+
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    prompt = ("User: explain this document. " * 300)[:8000]
+    raw = _grounded_reply()
+
+    print(f"prompt {len(prompt)} chars, reply {len(raw) // 1024} KiB, "
+          f"json backend {json_loads.__module__}")
+    for name, fn in (("before", _old_path), ("after", _new_path)):
+        fn(prompt, raw)  # warm up
+        started = time.process_time()
+        for _ in range(n):
+            fn(prompt, raw)
+        cpu = (time.process_time() - started) / n
+        print(f"{name:6}  {cpu * 1e6:8.1f} us CPU / request")